@@ -1,3 +1,5 @@
+import weakref
+
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
@@ -5,15 +7,47 @@ import torch.nn.functional as F
 
 from boilr.utils import to_np
 
+try:
+    import numba as nb
+except ImportError:
+    nb = None
+
+try:
+    from utils.fused_sample import fused_affine_sample
+except ModuleNotFoundError:  # run as a script from within utils/
+    from fused_sample import fused_affine_sample
+
 
 class SpatialTransformer:
-    def __init__(self, input_shape, output_shape):
+
+    # Max number of sampling grids cached in no-grad mode
+    grid_cache_size = 64
+
+    def __init__(self, input_shape, output_shape, use_amp=False,
+                 use_fused=False, use_compile=False, cache_grids=False):
         """
         :param input_shape: (H, W)
         :param output_shape: (H, W)
+        :param use_amp: resample float32 CUDA inputs in bfloat16
+        :param use_fused: use the fused Triton sampling kernel for CUDA inputs
+                    that need no gradient (see spatial_transformer)
+        :param use_compile: compile the transform with torch.compile
+                    (PyTorch >= 2.0)
+        :param cache_grids: in no-grad mode, cache sampling grids while the
+                    z_where tensor they were computed from is alive. Only
+                    useful when the same z_where is passed repeatedly.
         """
         self.input_shape = input_shape
         self.output_shape = output_shape
+        self.use_amp = use_amp
+        self.use_fused = use_fused
+        self._grid_cache = {} if cache_grids else None
+
+        # Fuse z_where inversion, expansion and grid generation. Shapes use
+        # automatic dynamic mode, so varying batch sizes (B, B * T, last
+        # batch) do not trigger a new compile each.
+        if use_compile and hasattr(torch, 'compile'):
+            self._transform = torch.compile(self._transform)
 
     def _transform(self, x, z_where, inverse):
         """
@@ -28,17 +62,51 @@ class SpatialTransformer:
         else:
             out_shp = self.output_shape
 
-        out = spatial_transformer(x, z_where, out_shp)
+        out = spatial_transformer(x, z_where, out_shp, use_amp=self.use_amp,
+                                  use_fused=self.use_fused)
         return out
 
+    def _cached_transform(self, x, z_where, inverse):
+        """
+        Same as _transform, but with cache_grids and in no-grad mode the
+        sampling grid is cached, so repeated calls with the same z_where (e.g.
+        when visualizing) skip grid generation. Not used on the fused CUDA
+        path, which never materializes the grid.
+        """
+        if (self._grid_cache is None or torch.is_grad_enabled()
+                or _use_fused(x, z_where, self.use_fused)):
+            return self._transform(x, z_where, inverse)
+
+        key = (z_where.data_ptr(), z_where.shape, z_where.stride(),
+               z_where._version, z_where.device, inverse)
+        entry = self._grid_cache.get(key)
+        if entry is None:
+            if inverse:
+                theta = expand_z_where(invert_z_where(z_where))
+                out_shp = self.input_shape
+            else:
+                theta = expand_z_where(z_where)
+                out_shp = self.output_shape
+            grid = affine_grid(theta, out_shp)
+            cache = self._grid_cache
+            if len(cache) >= self.grid_cache_size:
+                del cache[next(iter(cache))]
+            # The entry is dropped as soon as z_where is freed, so a key can
+            # only match while its memory still belongs to z_where. The
+            # version counter catches in-place updates.
+            ref = weakref.ref(z_where, lambda _, k=key: cache.pop(k, None))
+            cache[key] = entry = (ref, grid)
+        return _grid_sample(x, entry[1], self.use_amp)
+
     def forward(self, x, z_where):
-        return self._transform(x, z_where, inverse=False)
+        return self._cached_transform(x, z_where, inverse=False)
 
     def inverse(self, x, z_where):
-        return self._transform(x, z_where, inverse=True)
+        return self._cached_transform(x, z_where, inverse=True)
 
 
-def spatial_transformer(x, z_where, out_shape):
+def spatial_transformer(x, z_where, out_shape, use_amp=False,
+                        use_fused=False):
     """
     Resamples x on a grid of shape out_shape based on an affine transform
     parameterized by z_where.
@@ -47,14 +115,75 @@ def spatial_transformer(x, z_where, out_shape):
     :param x:
     :param z_where:
     :param out_shape:
+    :param use_amp: if x is a float32 CUDA tensor, read it in bfloat16 to
+                halve memory traffic. The affine parameters and the grid
+                are computed in float32, and the output is float32.
+    :param use_fused: resample with the fused Triton kernel, which never
+                materializes the grid. Only used for CUDA inputs in float32,
+                float16 or bfloat16 when no gradient is needed, and only if
+                Triton is available.
     :return:
     """
-    batch_sz = x.size(0)
     theta = expand_z_where(z_where)
-    grid_shape = torch.Size((batch_sz, 1) + out_shape)
-    grid = F.affine_grid(theta, grid_shape, align_corners=False)
-    out = F.grid_sample(x, grid, align_corners=False)
-    return out
+    if _use_fused(x, theta, use_fused):
+        # Sampling coordinates are computed in float32 inside the kernel
+        if _amp_enabled(x, use_amp):
+            return fused_affine_sample(
+                x.to(torch.bfloat16), theta, *out_shape).float()
+        return fused_affine_sample(x, theta, *out_shape)
+    grid = affine_grid(theta, out_shape)
+    return _grid_sample(x, grid, use_amp)
+
+def _amp_enabled(x, use_amp):
+    return use_amp and x.is_cuda and x.dtype == torch.float32
+
+def _grid_sample(x, grid, use_amp=False):
+    """
+    F.grid_sample with align_corners=False. With use_amp (see
+    spatial_transformer), the finished float32 grid is cast to bfloat16 only
+    because grid_sample needs input and grid of the same dtype. The casts are
+    explicit because autocast keeps grid_sample in float32.
+    """
+    if _amp_enabled(x, use_amp):
+        out = F.grid_sample(x.to(torch.bfloat16), grid.to(torch.bfloat16),
+                            align_corners=False)
+        return out.float()
+    return F.grid_sample(x, grid, align_corners=False)
+
+# The fused kernel computes in float32, so float64 inputs use the unfused path
+_FUSED_DTYPES = (torch.float32, torch.float16, torch.bfloat16)
+
+def _use_fused(x, theta, use_fused):
+    """
+    The fused kernel has no backward, so it is only used on CUDA when no
+    gradient has to flow to x or theta (or z_where, which theta comes from).
+    """
+    if not (use_fused and x.is_cuda and fused_affine_sample is not None):
+        return False
+    if x.dtype not in _FUSED_DTYPES:
+        return False
+    needs_grad = x.requires_grad or theta.requires_grad
+    return not (torch.is_grad_enabled() and needs_grad)
+
+def affine_grid(theta, out_shape):
+    """
+    Equivalent to F.affine_grid(theta, (N, C) + out_shape, align_corners=False),
+    but computed as a broadcast sum of outer products instead of a batched
+    matmul with a materialized (N, H, W, 3) base grid.
+
+    :param theta: (N, 2, 3) affine matrices
+    :param out_shape: (H, W)
+    :return: sampling grid of shape (N, H, W, 2)
+    """
+    h, w = out_shape
+    # Columns of theta, each of shape (N, 1, 1, 2)
+    theta_w, theta_h, theta_c = theta[:, None, None].unbind(-1)
+    # Pixel centers in [-1, 1] (align_corners=False)
+    lin_h = torch.linspace(-1, 1, h, device=theta.device, dtype=theta.dtype)
+    lin_w = torch.linspace(-1, 1, w, device=theta.device, dtype=theta.dtype)
+    lin_h = (lin_h * (h - 1) / h)[None, :, None, None]
+    lin_w = (lin_w * (w - 1) / w)[None, None, :, None]
+    return theta_c + theta_h * lin_h + theta_w * lin_w
 
 def expand_z_where(z_where):
     """
@@ -62,25 +191,21 @@ def expand_z_where(z_where):
     :return: [[s, 0, x], [0, s, y]]
     """
     bs = z_where.size(0)
-    dev = z_where.device
-
-    # [s, x, y] -> [s, 0, x, 0, s, y]
-    z_where = torch.cat((torch.zeros(bs, 1, device=dev), z_where), dim=1)
-    expansion_indices = torch.tensor([1, 0, 2, 0, 1, 3], device=dev)
-    matrix = torch.index_select(z_where, dim=1, index=expansion_indices)
-    matrix = matrix.view(bs, 2, 3)
-
+    matrix = z_where.new_zeros(bs, 2, 3)
+    matrix[:, 0, 0] = z_where[:, 0]
+    matrix[:, 1, 1] = z_where[:, 0]
+    matrix[:, 0, 2] = z_where[:, 1]
+    matrix[:, 1, 2] = z_where[:, 2]
     return matrix
 
 def invert_z_where(z_where):
-    z_where_inv = torch.zeros_like(z_where)
-    scale = z_where[:, 0:1]   # (batch, 1)
-    z_where_inv[:, 1:3] = -z_where[:, 1:3] / scale   # (batch, 2)
-    z_where_inv[:, 0:1] = 1 / scale    # (batch, 1)
-    return z_where_inv
+    inv_s = 1 / z_where[:, 0]   # (batch,)
+    return torch.stack(
+        (inv_s, -z_where[:, 1] * inv_s, -z_where[:, 2] * inv_s), dim=1)
 
 
-def batch_add_bounding_boxes(imgs, z_wheres, n_obj, color=None, n_img=None):
+def batch_add_bounding_boxes(imgs, z_wheres, n_obj, color=None, n_img=None,
+                             uint8=False, use_numba=True):
     """
 
     :param imgs: 4d tensor of numpy array, channel dim either 1 or 3
@@ -88,35 +213,155 @@ def batch_add_bounding_boxes(imgs, z_wheres, n_obj, color=None, n_img=None):
     :param n_obj:
     :param color:
     :param n_img:
+    :param uint8: if True, images in [0, 1] are quantized once to uint8 and
+                the output is a uint8 tensor in [0, 255]
+    :param use_numba: paint with the compiled Numba kernel if Numba is
+                available, otherwise with the vectorized NumPy painter
     :return:
     """
 
     # Check arguments
-    assert len(imgs.shape) == 4
-    assert imgs.shape[1] in [1, 3]
-    assert len(z_wheres.shape) == 3
-    assert z_wheres.shape[0] == imgs.shape[0]
-    assert z_wheres.shape[2] == 3
-
-    target_shape = list(imgs.shape)
-    target_shape[1] = 3
+    if __debug__:
+        assert len(imgs.shape) == 4
+        assert imgs.shape[1] in [1, 3]
+        assert len(z_wheres.shape) == 3
+        assert z_wheres.shape[0] == imgs.shape[0]
+        assert z_wheres.shape[2] == 3
+        target_shape = list(imgs.shape)
+        target_shape[1] = 3
 
     if n_img is None:
         n_img = len(imgs)
     if color is None:
         color = np.array([1., 0., 0.])
-    out = torch.stack([
-        add_bounding_boxes(imgs[j], z_wheres[j], color, n_obj[j])
-        for j in range(n_img)
-    ])
-
-    out_shape = tuple(out.shape)
-    target_shape = tuple(target_shape)
-    assert out_shape == target_shape, "{}, {}".format(out_shape, target_shape)
+
+    z_wheres = to_np(z_wheres[:n_img])
+    n_obj = np.round(to_np(n_obj[:n_img])).astype(int)
+    if __debug__:
+        assert (n_obj <= z_wheres.shape[1]).all()
+
+    # Single allocation for the output, grayscale is broadcast to RGB
+    imgs = to_np(imgs[:n_img])
+    if uint8:
+        imgs = _quantize(imgs)
+        color = _quantize(np.asarray(color))
+    out = np.empty((n_img, 3) + imgs.shape[2:], dtype=imgs.dtype)
+    out[:] = imgs
+
+    # Draw all boxes of all images at once
+    x1, x2, y1, y2 = _bounding_box_coords(z_wheres, out.shape[2])
+    if use_numba and _paint_boxes_numba is not None:
+        color = np.asarray(color, dtype=out.dtype)
+        _paint_boxes_numba(out, x1, x2, y1, y2, n_obj, color)
+    else:
+        valid = np.arange(z_wheres.shape[1]) < n_obj[:, None]
+        _paint_boxes(out, x1, x2, y1, y2, valid, color)
+    out = torch.from_numpy(out)
+
+    if __debug__:
+        out_shape = tuple(out.shape)
+        target_shape = tuple(target_shape)
+        assert out_shape == target_shape, "{}, {}".format(
+            out_shape, target_shape)
     return out
 
 
-def add_bounding_boxes(img, z_wheres, color, n_obj):
+def _bounding_box_coords(z_wheres, x_size, margin=1):
+    """
+    Vectorized bounding box coordinates, same as computed by add_bounding_box.
+
+    :param z_wheres: numpy array of shape (..., 3)
+    :param x_size: image size
+    :param margin: margin around the box
+    :return: rounded integer coordinates (x1, x2, y1, y2), each with shape
+                z_wheres.shape[:-1]
+    """
+    s, x, y = z_wheres[..., 0], z_wheres[..., 1], z_wheres[..., 2]
+    w = x_size / s
+    h = x_size / s
+    xtrans = -x / s * x_size / 2
+    ytrans = -y / s * x_size / 2
+    x1 = (x_size - w) / 2 + xtrans - margin
+    y1 = (x_size - h) / 2 + ytrans - margin
+    x2 = x1 + w + 2 * margin
+    y2 = y1 + h + 2 * margin
+    x1, x2 = np.minimum(x1, x2), np.maximum(x1, x2)
+    y1, y2 = np.minimum(y1, y2), np.maximum(y1, y2)
+    return tuple(np.round(c).astype(int) for c in (x1, x2, y1, y2))
+
+
+def _paint_boxes(imgs, x1, x2, y1, y2, valid, color):
+    """
+    Paints bounding boxes in place, with one advanced-index assignment per
+    edge type. Drawing rules are the same as in add_bounding_box.
+
+    :param imgs: numpy array of shape (B, 3, H, W), modified in place
+    :param x1: integer box coordinates, shape (B, K). Same for x2, y1, y2.
+    :param valid: boolean mask of shape (B, K), only these boxes are drawn
+    :param color: RGB color of all boxes
+    """
+    x_max = y_max = imgs.shape[2] - 1
+    idx = np.arange(imgs.shape[2])
+    in_x = ((idx >= np.maximum(x1, 0)[..., None])
+            & (idx < np.minimum(x2, x_max)[..., None]))  # (B, K, W)
+    in_y = ((idx >= np.maximum(y1, 0)[..., None])
+            & (idx < np.minimum(y2, y_max)[..., None]))  # (B, K, H)
+
+    # Horizontal edges
+    for row in (y1, y2 - 1):
+        draw = valid & (0 <= row) & (row <= y_max)
+        b, k, col = np.nonzero(in_x & draw[..., None])
+        imgs[b, :, row[b, k], col] = color
+
+    # Vertical edges
+    for col in (x1, x2 - 1):
+        draw = valid & (0 <= col) & (col <= x_max)
+        b, k, row = np.nonzero(in_y & draw[..., None])
+        imgs[b, :, row, col[b, k]] = color
+
+
+if nb is not None:
+
+    @nb.njit(parallel=True, cache=True)
+    def _paint_boxes_numba(imgs, x1, x2, y1, y2, n_obj, color):
+        """
+        Compiled equivalent of _paint_boxes, parallel over images. Only the
+        first n_obj[b] boxes of image b are drawn.
+
+        :param imgs: numpy array of shape (B, 3, H, W), modified in place
+        :param x1: integer box coordinates from _bounding_box_coords, shape
+                    (B, K). Same for x2, y1, y2.
+        :param n_obj: integer numpy array of shape (B,)
+        :param color: RGB color of all boxes, same dtype as imgs
+        """
+        n_ch = imgs.shape[1]
+        x_max = y_max = imgs.shape[2] - 1
+        for b in nb.prange(imgs.shape[0]):
+            for k in range(n_obj[b]):
+                x_lo = max(x1[b, k], 0)
+                x_hi = min(x2[b, k], x_max)
+                y_lo = max(y1[b, k], 0)
+                y_hi = min(y2[b, k], y_max)
+                top, bottom = y1[b, k], y2[b, k] - 1
+                left, right = x1[b, k], x2[b, k] - 1
+                # Explicit loops: empty (never wrapping) if hi < lo
+                for c in range(n_ch):
+                    for j in range(x_lo, x_hi):
+                        if 0 <= top <= y_max:
+                            imgs[b, c, top, j] = color[c]
+                        if 0 <= bottom <= y_max:
+                            imgs[b, c, bottom, j] = color[c]
+                    for i in range(y_lo, y_hi):
+                        if 0 <= left <= x_max:
+                            imgs[b, c, i, left] = color[c]
+                        if 0 <= right <= x_max:
+                            imgs[b, c, i, right] = color[c]
+
+else:
+    _paint_boxes_numba = None
+
+
+def add_bounding_boxes(img, z_wheres, color, n_obj, uint8=False):
     """
     Adds bounding boxes to the n_obj objects in img, according to z_wheres.
     The output is never on cuda.
@@ -131,6 +376,8 @@ def add_bounding_boxes(img, z_wheres, color, n_obj):
                 bounding boxes to be drawn, and cannot be greater than the
                 max number of objects supported by z_where (dim=1). Has to be
                 a scalar or a single-element Tensor/array.
+    :param uint8: if True, the image in [0, 1] is quantized once to uint8 and
+                boxes are drawn in uint8. The output has dtype uint8.
     :return: image with required bounding boxes, with same type and dimension
                 as the original image input, except 3 color channels.
     """
@@ -140,40 +387,29 @@ def add_bounding_boxes(img, z_wheres, color, n_obj):
     except AttributeError:
         pass
     n_obj = int(round(n_obj))
-    assert n_obj <= z_wheres.shape[1]
 
-    try:
-        img = img.cpu()
-    except AttributeError:
-        pass
-
-    if len(img.shape) == 3:
-        color_dim = 0
-    else:
-        color_dim = 1
-
-    if len(z_wheres.shape) == 3:
-        assert z_wheres.shape[0] == 1
-        z_wheres = z_wheres[0]
-
-    target_shape = list(img.shape)
-    target_shape[color_dim] = 3
-
-    for i in range(n_obj):
-        img = add_bounding_box(img, z_wheres[i:i+1], color)
-    if img.shape[color_dim] == 1:  # this might happen if n_obj==0
-        reps = [3, 1, 1]
-        if color_dim == 1:
-            reps = [1] + reps
-        reps = tuple(reps)
-        if isinstance(img, torch.Tensor):
-            img = img.repeat(*reps)
-        else:
-            img = np.tile(img, reps)
-
-    target_shape = tuple(target_shape)
-    img_shape = tuple(img.shape)
-    assert img_shape == target_shape, "{}, {}".format(img_shape, target_shape)
+    if __debug__:
+        assert len(z_wheres.shape) == 2 or z_wheres.shape[0] == 1
+        assert n_obj <= z_wheres.shape[-2]
+        color_dim = 0 if len(img.shape) == 3 else 1
+        target_shape = list(img.shape)
+        target_shape[color_dim] = 3
+
+    # Convert inputs once, then draw all boxes on the same buffer at once
+    z_wheres = to_np(z_wheres).reshape(1, -1, 3)[:, :n_obj]
+    if uint8:
+        color = _quantize(np.asarray(color))
+    buf, collapse_first, torch_tensor = _to_rgb_buffer(img, uint8)
+    x1, x2, y1, y2 = _bounding_box_coords(z_wheres, buf.shape[2])
+    valid = np.ones(x1.shape, dtype=bool)
+    _paint_boxes(buf, x1, x2, y1, y2, valid, color)
+    img = _from_rgb_buffer(buf, collapse_first, torch_tensor)
+
+    if __debug__:
+        target_shape = tuple(target_shape)
+        img_shape = tuple(img.shape)
+        assert img_shape == target_shape, "{}, {}".format(
+            img_shape, target_shape)
     return img
 
 
@@ -192,61 +428,108 @@ def add_bounding_box(img, z_where, color):
                 type and dimension as the original image input, except 3 color
                 channels.
     """
-    def _bounding_box(z_where, x_size, rounded=True, margin=1):
-        z_where = to_np(z_where).flatten()
-        assert z_where.shape[0] == z_where.size == 3
-        s, x, y = tuple(z_where)
-        w = x_size / s
-        h = x_size / s
-        xtrans = -x / s * x_size / 2
-        ytrans = -y / s * x_size / 2
-        x1 = (x_size - w) / 2 + xtrans - margin
-        y1 = (x_size - h) / 2 + ytrans - margin
-        x2 = x1 + w + 2 * margin
-        y2 = y1 + h + 2 * margin
-        x1, x2 = sorted((x1, x2))
-        y1, y2 = sorted((y1, y2))
-        coords = (x1, x2, y1, y2)
-        if rounded:
-            coords = (int(round(t)) for t in coords)
-        return coords
-
-    target_shape = list(img.shape)
-    collapse_first = False
+    if __debug__:
+        target_shape = list(img.shape)
+        target_shape[len(img.shape) - 3] = 3
+
+    buf, collapse_first, torch_tensor = _to_rgb_buffer(img)
+    coords = _bounding_box(z_where, buf.shape[2])
+    _paint_box_inplace(buf, coords, color[:, None])
+    img = _from_rgb_buffer(buf, collapse_first, torch_tensor)
+
+    if __debug__:
+        target_shape = tuple(target_shape)
+        img_shape = tuple(img.shape)
+        assert img_shape == target_shape, "{}, {}".format(
+            img_shape, target_shape)
+    return img
+
+
+def _to_rgb_buffer(img, uint8=False):
+    """
+    Makes a 4d RGB numpy copy of img, on which bounding boxes can be drawn in
+    place. Grayscale images are broadcast to 3 channels. This is the only
+    device-to-host transfer of img.
+
+    :param img: image in 3d or 4d shape, either Tensor or numpy. If 4d, the
+                first dimension must be 1.
+    :param uint8: quantize img to uint8 before broadcasting it to RGB
+    :return: (buffer, collapse_first, torch_tensor), where the last two are
+                needed by _from_rgb_buffer to restore the input format.
+    """
     torch_tensor = isinstance(img, torch.Tensor)
-    img = to_np(img).copy()
-    if len(img.shape) == 3:
-        collapse_first = True
+    img = to_np(img)
+    collapse_first = len(img.shape) == 3
+    if collapse_first:
         img = np.expand_dims(img, 0)
-        target_shape[0] = 3
-    else:
-        target_shape[1] = 3
-    assert len(img.shape) == 4 and img.shape[0] == 1
-    if img.shape[1] == 1:
-        img = np.tile(img, (1, 3, 1, 1))
-    assert img.shape[1] == 3
-    color = color[:, None]
-
-    x1, x2, y1, y2 = _bounding_box(z_where, img.shape[2])
-    x_max = y_max = img.shape[2] - 1
+    if __debug__:
+        assert len(img.shape) == 4 and img.shape[0] == 1
+        assert img.shape[1] in [1, 3]
+    if uint8:
+        img = _quantize(img)
+    buf = np.broadcast_to(img, (1, 3) + img.shape[2:]).copy()
+    return buf, collapse_first, torch_tensor
+
+
+def _from_rgb_buffer(buf, collapse_first, torch_tensor):
+    if collapse_first:
+        buf = buf[0]
+    if torch_tensor:
+        buf = torch.from_numpy(buf)
+    return buf
+
+
+def _quantize(x):
+    """
+    Maps a numpy array with values in [0, 1] to uint8 in [0, 255], rounding
+    to the nearest integer.
+    """
+    return np.clip(x * 255 + 0.5, 0, 255).astype(np.uint8)
+
+
+def _bounding_box(z_where, x_size, rounded=True, margin=1):
+    z_where = to_np(z_where).flatten()
+    if __debug__:
+        assert z_where.shape[0] == z_where.size == 3
+    s, x, y = tuple(z_where)
+    w = x_size / s
+    h = x_size / s
+    xtrans = -x / s * x_size / 2
+    ytrans = -y / s * x_size / 2
+    x1 = (x_size - w) / 2 + xtrans - margin
+    y1 = (x_size - h) / 2 + ytrans - margin
+    x2 = x1 + w + 2 * margin
+    y2 = y1 + h + 2 * margin
+    x1, x2 = min(x1, x2), max(x1, x2)
+    y1, y2 = min(y1, y2), max(y1, y2)
+    coords = (x1, x2, y1, y2)
+    if rounded:
+        coords = tuple(int(round(t)) for t in coords)
+    return coords
+
+
+def _paint_box_inplace(buf, coords, color):
+    """
+    Paints one bounding box on buf in place.
+
+    :param buf: RGB numpy array of shape (1, 3, H, W)
+    :param coords: integer box coordinates (x1, x2, y1, y2)
+    :param color: RGB color as a column, shape (3, 1)
+    """
+    x1, x2, y1, y2 = coords
+    x_max = y_max = buf.shape[2] - 1
+    # Edge extents clipped to the canvas in one call. Clipping the end at 0
+    # also keeps negative ends from wrapping around.
+    x_lo, x_hi, y_lo, y_hi = np.clip(coords, 0, x_max)
     if 0 <= y1 <= y_max:
-        img[0, :, y1, max(x1, 0):min(x2, x_max)] = color
+        buf[0, :, y1, x_lo:x_hi] = color
     if 0 <= y2 - 1 <= y_max:
-        img[0, :, y2 - 1, max(x1, 0):min(x2, x_max)] = color
+        buf[0, :, y2 - 1, x_lo:x_hi] = color
     if 0 <= x1 <= x_max:
-        img[0, :, max(y1, 0):min(y2, y_max), x1] = color
+        buf[0, :, y_lo:y_hi, x1] = color
     if 0 <= x2 - 1 <= x_max:
-        img[0, :, max(y1, 0):min(y2, y_max), x2 - 1] = color
+        buf[0, :, y_lo:y_hi, x2 - 1] = color
 
-    if collapse_first:
-        img = img[0]
-    if torch_tensor:
-        img = torch.from_numpy(img)
-
-    target_shape = tuple(target_shape)
-    img_shape = tuple(img.shape)
-    assert img_shape == target_shape, "{}, {}".format(img_shape, target_shape)
-    return img
 
 def _test(obj_size, canvas_size, color_ch):
 
@@ -295,7 +578,44 @@ def _test(obj_size, canvas_size, color_ch):
     plt.imshow(img_np[0].transpose(1, 2, 0), vmin=0., vmax=1.)
     plt.show()
 
-    # case nobj = 0 missing
+    # All painters agree: Numba and NumPy batch painters, and the scalar
+    # painter of add_bounding_box. Boxes can be partly or entirely off the
+    # canvas (including negative coordinates), and some images have n_obj=0.
+    n_img, max_obj = 16, 4
+    imgs = torch.rand(n_img, color_ch, canvas_size, canvas_size)
+    scale = (torch.rand(n_img, max_obj) * 5 + 0.5)
+    scale *= torch.randint(0, 2, scale.shape) * 2. - 1  # flipped boxes
+    pos = torch.randn(n_img, max_obj, 2) * 4
+    z_wheres = torch.cat((scale[..., None], pos), dim=-1)
+    n_obj = torch.randint(0, max_obj + 1, (n_img,))
+    n_obj[:2] = 0
+    expected = []
+    for j in range(n_img):
+        img_j = imgs[j].expand(3, -1, -1).clone()
+        for i in range(n_obj[j]):
+            img_j = add_bounding_box(img_j, z_wheres[j, i], color)
+        expected.append(img_j)
+    expected = torch.stack(expected)
+    for use_numba in [True, False]:
+        out = batch_add_bounding_boxes(
+            imgs, z_wheres, n_obj, color, use_numba=use_numba)
+        assert torch.equal(out, expected)
+    for j in [0, 2]:
+        out = add_bounding_boxes(imgs[j], z_wheres[j], color, n_obj[j])
+        assert torch.equal(out, expected[j])
+
+    # uint8 mode quantizes once before painting, which must give the same
+    # result as quantizing the float output afterwards
+    expected_u8 = torch.from_numpy(_quantize(expected.numpy()))
+    for use_numba in [True, False]:
+        out = batch_add_bounding_boxes(
+            imgs, z_wheres, n_obj, color, uint8=True, use_numba=use_numba)
+        assert out.dtype == torch.uint8
+        assert torch.equal(out, expected_u8)
+    for j in [0, 2]:
+        out = add_bounding_boxes(
+            imgs[j], z_wheres[j], color, n_obj[j], uint8=True)
+        assert torch.equal(out, expected_u8[j])
 
 
 if __name__ == '__main__':